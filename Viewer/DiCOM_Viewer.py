@@ -1,11 +1,41 @@
 import pydicom
 import numpy as np
 import os
+import tempfile
 from glob import glob
+from collections import defaultdict
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import ttk
-from PIL import Image, ImageTk 
+from PIL import Image
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# GPUへ転送するボリュームの最小ボクセル数 (512x512x300 程度以上の大きなシリーズのみ)
+GPU_MIN_VOXELS = 512 * 512 * 300
+
+# --- WL/WW処理カーネル (numbaが利用可能な場合のみ) ---
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _window_kernel(hu, out, min_val, max_val, scale):
+        # クリップ・スケーリング・uint8変換を1パスで行う
+        for i in prange(hu.shape[0]):
+            for j in range(hu.shape[1]):
+                # 分岐を使わずmin/maxで飽和させ、内側ループをベクトル化しやすくする
+                v = min(max(hu[i, j], min_val), max_val)
+                out[i, j] = np.uint8((v - min_val) * scale)
+else:
+    _window_kernel = None
 
 # --- DICOMデータ処理クラス ---
 class DICOMDataLoader:
@@ -14,12 +44,40 @@ class DICOMDataLoader:
         self.header_info = {}
         self.is_loaded = False
         self.full_hu_volume = None 
+        # 冠状断・矢状断用の連続メモリボリューム (初回表示時に作成)
+        self._cor = None
+        self._sag = None
+        # GPU上のボリューム (cupyが利用可能な場合のみ)
+        self.gpu_volume = None
+        # ボリュームを保持する一時ファイルのパス
+        self._mm_paths = []
+        
+    def __del__(self):
+        self.close()
+        
+    def close(self):
+        self.is_loaded = False
+        self.full_hu_volume = None
+        self.gpu_volume = None
+        self._cor = None
+        self._sag = None
+        
+        # マップ中で削除できなかったファイル (Windows) は残し、次回のclose()で再試行する
+        remaining_paths = []
+        for path in self._mm_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                remaining_paths.append(path)
+        self._mm_paths = remaining_paths
         
     def load_series(self, folder_path):
         self.series_data = []
         self.header_info = {}
         self.is_loaded = False
-        self.full_hu_volume = None
+        self.close()
         
         dcm_files = glob(os.path.join(folder_path, '*.dcm'))
         
@@ -47,41 +105,52 @@ class DICOMDataLoader:
         
         return "エラー: データの処理中に問題が発生しました。", False
 
-    def _sort_dicom_series(self, dcm_files):
-        series_map = {}
-        for filepath in dcm_files:
-            try:
-                ds = pydicom.dcmread(filepath)
-                # ファイルがPixel Dataを持たない場合はスキップ
-                if 'PixelData' not in ds:
-                    continue
-                    
-                key = ds.get('SeriesInstanceUID')
-                z_pos = ds.get('ImagePositionPatient', [0, 0, 0])[2] 
-                
-                if key not in series_map:
-                    series_map[key] = []
-                series_map[key].append((z_pos, ds))
+    def _read_one(self, filepath):
+        try:
+            # ソートに必要なタグのみを読み、Pixel Dataの手前で読み込みを止める
+            ds = pydicom.dcmread(filepath, stop_before_pixels=True,
+                                 specific_tags=['SeriesInstanceUID', 'ImagePositionPatient', 'Rows'])
+            
+            # 画像を持たないファイル (Rowsタグが無い) はスキップ
+            if 'Rows' not in ds:
+                return None
                 
-            except Exception:
-                # DICOMファイルとして無効なファイルをスキップ
+            key = ds.get('SeriesInstanceUID')
+            z_pos = ds.get('ImagePositionPatient', [0, 0, 0])[2] 
+            return key, z_pos, filepath
+            
+        except Exception:
+            # DICOMファイルとして無効なファイル (タグ値の不正を含む) をスキップ
+            return None
+
+    def _sort_dicom_series(self, dcm_files):
+        # ファイル読み込みはI/O待ちが支配的なため、スレッドで並列に読む
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(self._read_one, dcm_files))
+            
+        series_map = defaultdict(list)
+        for result in results:
+            if result is None:
                 continue
                 
+            key, z_pos, filepath = result
+            series_map[key].append((z_pos, filepath))
+                
         if not series_map:
             return []
             
-        main_series_uid = max(series_map, key=lambda k: len(series_map[k]))
+        main_series_uid = max(series_map.items(), key=lambda kv: len(kv[1]))[0]
         main_series = series_map[main_series_uid]
         
-        main_series.sort(key=lambda x: x[0])
+        main_series.sort(key=itemgetter(0))
         return [item[1] for item in main_series]
 
-    def _process_data(self, sorted_datasets):
+    def _process_data(self, sorted_files):
         
-        if not sorted_datasets:
+        if not sorted_files:
             return
             
-        ds0 = sorted_datasets[0]
+        ds0 = pydicom.dcmread(sorted_files[0], stop_before_pixels=True)
         self.header_info = {
             'Rows': ds0.get('Rows', 0),
             'Columns': ds0.get('Columns', 0),
@@ -97,46 +166,101 @@ class DICOMDataLoader:
         
         rows = self.header_info['Rows']
         cols = self.header_info['Columns']
-        num_slices = len(sorted_datasets)
-
-        self.full_hu_volume = np.zeros((num_slices, rows, cols), dtype=np.float32)
-        
-        all_hu_values = [] # 初期WL/WW設定のために全HU値を一時保存
-        
-        for i, ds in enumerate(sorted_datasets):
-            pixel_array = ds.pixel_array.astype(np.int16) 
-            hu_array = pixel_array * R_slope + R_int
-            self.full_hu_volume[i] = hu_array
-            all_hu_values.append(hu_array.ravel())
+        num_slices = len(sorted_files)
+
+        # 傾きが1かつ切片が整数の場合 (ほぼ全てのCT) はint16で保持し、メモリを半減する
+        use_int16 = float(R_slope) == 1.0 and float(R_int).is_integer()
+        int16_info = np.iinfo(np.int16)
+        hu_dtype = np.int16 if use_int16 else np.float32
+        
+        self.full_hu_volume = self._create_volume((num_slices, rows, cols), hu_dtype)
+        
+        def fill_slice(i):
+            # Pixel Dataの読み込みとデコードは採用したシリーズのファイルのみ行う
+            ds = pydicom.dcmread(sorted_files[i])
+            hu_slice = self.full_hu_volume[i]
+            # 確保済みのボリュームへ直接書き込む
+            pixel_array = ds.pixel_array
+            if use_int16:
+                # int32で加算してからint16の範囲に飽和させる
+                # (パディング値 -32768 + 切片 などが折り返して高HU値にならないようにする)
+                hu_int32 = np.add(pixel_array, np.int32(R_int), dtype=np.int32)
+                np.clip(hu_int32, int16_info.min, int16_info.max, out=hu_slice, casting='unsafe')
+            elif float(R_slope) == 1.0:
+                np.add(pixel_array, np.float32(R_int), out=hu_slice, dtype=np.float32, casting='unsafe')
+            else:
+                np.multiply(pixel_array, np.float32(R_slope), out=hu_slice, dtype=np.float32, casting='unsafe')
+                hu_slice += np.float32(R_int)
+            # 初期WL/WW設定のためのMin/Max HU値はスライスごとに求める
+            return hu_slice.min(), hu_slice.max()
+            
+        # 全HU値を保持せず、各スライスの結果が返るたびにMin/Maxを更新する
+        min_hu = np.inf
+        max_hu = -np.inf
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for slice_min, slice_max in executor.map(fill_slice, range(num_slices)):
+                min_hu = min(min_hu, slice_min)
+                max_hu = max(max_hu, slice_max)
             
         self.header_info['NumSlices'] = num_slices
+        
+        # int16ボリュームはCPU上の変換テーブル (1回の参照) の方が速いため、
+        # GPUを使うのは大きなfloat32ボリュームのみとする
+        if (cp is not None and hu_dtype == np.float32
+                and self.full_hu_volume.size >= GPU_MIN_VOXELS):
+            try:
+                self.gpu_volume = cp.asarray(self.full_hu_volume)
+            except Exception:
+                # GPUが使えない環境ではCPU上のボリュームをそのまま使う
+                self.gpu_volume = None
+        
         self.is_loaded = True
         
-        # Min/Max HU値の計算と初期値設定
-        if all_hu_values:
-            full_hu_array = np.concatenate(all_hu_values)
-            min_hu = np.min(full_hu_array)
-            max_hu = np.max(full_hu_array)
-            self.header_info['MinHU'] = min_hu
-            self.header_info['MaxHU'] = max_hu
-        else:
-            self.header_info['MinHU'] = 0.0
-            self.header_info['MaxHU'] = 0.0
+        # int16のままだとWL/WW計算時にオーバーフローするためfloatで保持
+        self.header_info['MinHU'] = float(min_hu)
+        self.header_info['MaxHU'] = float(max_hu)
+        
+    def _create_volume(self, shape, dtype):
+        # 大きなシリーズでもRAMに載せきらないよう、一時ファイルにマップしてOSにページングさせる
+        with tempfile.NamedTemporaryFile(suffix='.hu', delete=False) as f:
+            path = f.name
+        self._mm_paths.append(path)
+        return np.memmap(path, dtype=dtype, mode='w+', shape=shape)
         
     def get_slice_data(self, view_plane, index):
         if not self.is_loaded:
             return None
             
+        if self.gpu_volume is not None:
+            # GPU上では飛び飛びの参照も十分速いため、転置済みのコピーは作らない
+            volume = self.gpu_volume
+            if view_plane == 'Axial':
+                return volume[index, :, :]
+            elif view_plane == 'Coronal':
+                return volume[:, index, :]
+            elif view_plane == 'Sagittal':
+                return volume[:, :, index]
+            return None
+            
         volume = self.full_hu_volume
         
         if view_plane == 'Axial':
             return volume[index, :, :]
         
         elif view_plane == 'Coronal':
-            return volume[:, index, :]
+            # volume[:, index, :] は飛び飛びのメモリ参照になるため、転置済みのコピーから取り出す
+            if self._cor is None:
+                cor = volume.transpose(1, 0, 2)
+                self._cor = self._create_volume(cor.shape, volume.dtype)
+                self._cor[...] = cor
+            return self._cor[index]
             
         elif view_plane == 'Sagittal':
-            return volume[:, :, index]
+            if self._sag is None:
+                sag = volume.transpose(2, 0, 1)
+                self._sag = self._create_volume(sag.shape, volume.dtype)
+                self._sag[...] = sag
+            return self._sag[index]
 
         return None
         
@@ -177,6 +301,21 @@ class DICOMViewerApp:
         self.start_ww = self.window_width
         self.start_slice = self.current_slice
 
+        # int16ボリューム用のWL/WW変換テーブル (WL/WWが変わった時のみ再計算)
+        self._lut = None
+        self._lut_key = None
+        # float32ボリューム用のWL/WW処理バッファ (スライス形状が変わった時のみ再確保)
+        self._win_buf = None
+        self._u8_buf = None
+        # 描画要求の間引き用フラグ (ドラッグ中は簡易補間で描画する)
+        self._pending_render = False
+        self._interactive = False
+        self._hq_after_id = None
+        # 表示中のTk画像 (サイズが変わらない限り使い回す)
+        self.tk_img = None
+        # 直前に描画した状態 (同じ状態での再描画を省略する)
+        self._render_key = None
+
         # --- GUI レイアウト設定 (省略) ---
         main_frame = ttk.Frame(master, padding="10")
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -193,6 +332,7 @@ class DICOMViewerApp:
         # --- マウスイベントのバインド ---
         self.image_label.bind("<Button-1>", self.on_mouse_down)
         self.image_label.bind("<B1-Motion>", self.on_mouse_drag)
+        self.image_label.bind("<ButtonRelease-1>", self.on_mouse_up)
         self.image_label.bind("<Button-3>", self.on_mouse_down_right)
         self.image_label.bind("<B3-Motion>", self.on_mouse_drag_right)
         self.image_label.bind("<MouseWheel>", self.on_mouse_wheel)
@@ -275,9 +415,38 @@ class DICOMViewerApp:
             
             self.window_width = max(10.0, new_ww)
             self.window_level = new_wl
+            self._interactive = True
             
             self._update_wl_ww_gui()
-            self.update_image()
+            self._schedule_render()
+            
+    def on_mouse_up(self, event):
+        if self.data_loader.is_loaded and self._interactive:
+            # ドラッグ終了時に高品質な補間で描き直す
+            self._render_high_quality()
+            
+    def _schedule_render(self):
+        # 連続するイベントをまとめ、最新のWL/WWのみを1フレーム (約16ms) ごとに描画する
+        if not self._pending_render:
+            self._pending_render = True
+            self.master.after(16, self._do_render)
+            
+    def _do_render(self):
+        self._pending_render = False
+        self.update_image()
+        
+        if self._interactive:
+            # 操作が200ms止まったら高品質な補間で描き直す
+            if self._hq_after_id is not None:
+                self.master.after_cancel(self._hq_after_id)
+            self._hq_after_id = self.master.after(200, self._render_high_quality)
+            
+    def _render_high_quality(self):
+        if self._hq_after_id is not None:
+            self.master.after_cancel(self._hq_after_id)
+            self._hq_after_id = None
+        self._interactive = False
+        self.update_image()
             
     def _update_wl_ww_gui(self):
         self.wl_scale.set(self.window_level)
@@ -327,7 +496,9 @@ class DICOMViewerApp:
             
             max_index = self.get_max_slice_index(self.current_view)
             self.slice_label.config(text=f"スライス: {self.current_slice + 1} / {max_index + 1}")
-            self.update_image()
+            # スライス送り中も簡易補間で描画し、停止後に高品質化する
+            self._interactive = True
+            self._schedule_render()
 
     # --- その他のメソッド ---
 
@@ -349,6 +520,8 @@ class DICOMViewerApp:
                 self.window_width = max(10.0, max_hu - min_hu)
                 
                 self._update_wl_ww_gui()
+                # 新しいシリーズは必ず描画し直す
+                self._render_key = None
                 self._update_gui_after_load()
                 self.set_current_slice(0)
             else:
@@ -402,14 +575,30 @@ class DICOMViewerApp:
         self.wl_label.config(text=f"WL: {self.window_level:.1f}")
         self.ww_label.config(text=f"WW: {self.window_width:.1f}")
         if self.data_loader.is_loaded:
-            self.update_image()
+            # スライダー操作中も簡易補間で描画し、停止後に高品質化する
+            self._interactive = True
+            self._schedule_render()
 
     def update_slice(self, *args):
         new_slice = int(self.slice_scale.get())
         if new_slice != self.current_slice:
             self.set_current_slice(new_slice)
 
+    def _build_window_lut(self, min_val, scale):
+        # 添字をuint16として解釈した時のHU値 (0..32767, -32768..-1 の順)
+        hu_values = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.float32)
+        lut = np.clip((hu_values - min_val) * scale, 0, 255)
+        return lut.astype(np.uint8)
+
     def update_image(self):
+        # フォーカス変更などサイズの変わらない<Configure>では描画をやり直さない
+        render_key = (self.current_view, self.current_slice,
+                      round(self.window_level, 1), round(self.window_width, 1),
+                      self.image_frame.winfo_width(), self.image_frame.winfo_height(),
+                      self._interactive)
+        if render_key == self._render_key:
+            return
+            
         hu_data = self.data_loader.get_slice_data(self.current_view, self.current_slice)
         
         if hu_data is None:
@@ -420,24 +609,53 @@ class DICOMViewerApp:
         W = self.window_width
         L = self.window_level
         
-        min_val = L - W / 2
-        max_val = L + W / 2
-        
-        image_data = hu_data.copy()
-        image_data[image_data < min_val] = min_val
-        image_data[image_data > max_val] = max_val
-        
-        image_data = (image_data - min_val) / W * 255.0
-        image_data = image_data.astype(np.uint8)
-        
-        # 2. Pillowへの変換とアスペクト比の補正
-        img = Image.fromarray(image_data, mode='L')
+        # float64への昇格を避けるため、定数はfloat32で用意する
+        min_val = np.float32(L - W / 2)
+        max_val = np.float32(L + W / 2)
+        scale = np.float32(255.0 / W)
+        
+        if cp is not None and isinstance(hu_data, cp.ndarray):
+            # GPU上でWL/WW処理を行い、uint8のスライスのみCPUへ転送する
+            # (転送量はfloat32の1/4で、512x512でも256KB程度。リサイズは操作中の間引きと
+            #  停止後のLANCZOSをCPU経路と共通にするため、転送後にPillowで行う)
+            gpu_data = hu_data.astype(cp.float32)
+            cp.clip(gpu_data, min_val, max_val, out=gpu_data)
+            gpu_data -= min_val
+            gpu_data *= scale
+            image_data = cp.asnumpy(gpu_data.astype(cp.uint8))
+        elif hu_data.dtype == np.int16:
+            # int16ボリュームは全HU値分の変換テーブルを引くだけで済む
+            lut_key = (L, W)
+            if lut_key != self._lut_key:
+                self._lut = self._build_window_lut(min_val, scale)
+                self._lut_key = lut_key
+            # テーブル自体が窓外を0/255に飽和させているため、クリップ処理は不要
+            image_data = self._lut.take(hu_data.view(np.uint16))
+        else:
+            if self._u8_buf is None or self._u8_buf.shape != hu_data.shape:
+                self._u8_buf = np.empty(hu_data.shape, dtype=np.uint8)
+                
+            if _window_kernel is not None:
+                _window_kernel(hu_data, self._u8_buf, min_val, max_val, scale)
+            else:
+                # float32の作業バッファはNumPy経路でのみ使う
+                if self._win_buf is None or self._win_buf.shape != hu_data.shape:
+                    self._win_buf = np.empty(hu_data.shape, dtype=np.float32)
+                win_buf = self._win_buf
+                np.clip(hu_data, min_val, max_val, out=win_buf)
+                win_buf -= min_val
+                win_buf *= scale
+                np.copyto(self._u8_buf, win_buf, casting='unsafe')
+            image_data = self._u8_buf
+        
+        # 2. アスペクト比の補正
         aspect_ratio = self.data_loader.get_aspect_ratio(self.current_view)
         
-        img_width, img_height = img.size
+        img_height, img_width = image_data.shape
         frame_width = self.image_frame.winfo_width() - 20
         frame_height = self.image_frame.winfo_height() - 20
         
+        target_size = None
         if frame_width > 0 and frame_height > 0:
             
             if frame_width / frame_height > aspect_ratio:
@@ -448,18 +666,42 @@ class DICOMViewerApp:
                 target_height = int(target_width / aspect_ratio)
 
             if target_width > 0 and target_height > 0:
-                img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
+                target_size = (target_width, target_height)
+                
+        if target_size is not None and self._interactive:
+            # 操作中は整数間引きで先に縮小し、Pillowで補間する画素数を減らす
+            step_y = max(1, img_height // target_height)
+            step_x = max(1, img_width // target_width)
+            image_data = image_data[::step_y, ::step_x]
+            
+        if target_size is not None and image_data.shape != (target_size[1], target_size[0]):
+            img = Image.fromarray(image_data, mode='L')
+            resample = Image.Resampling.BILINEAR if self._interactive else Image.Resampling.LANCZOS
+            img = img.resize(target_size, resample)
+            width, height = img.size
+            pixels = img.tobytes()
+        else:
+            # 表示サイズと一致する場合はPillowを経由しない
+            height, width = image_data.shape
+            pixels = image_data.tobytes()
+        
+        # 3. Tkinterでの描画 (PGM形式のバイト列をそのままTkに渡す)
+        pgm_data = f"P5\n{width} {height}\n255\n".encode() + pixels
         
-        # 3. Tkinterでの描画
-        self.tk_img = ImageTk.PhotoImage(image=img)
+        if self.tk_img is None or (self.tk_img.width(), self.tk_img.height()) != (width, height):
+            self.tk_img = tk.PhotoImage(data=pgm_data, format='PPM')
+        else:
+            self.tk_img.configure(data=pgm_data, format='PPM')
         
         self.image_label.config(image=self.tk_img, text="")
         self.image_label.image = self.tk_img
         self.image_label.pack_configure(expand=True)
+        self._render_key = render_key
         
 # --- メイン実行部分 ---
 if __name__ == "__main__":
     root = tk.Tk()
     app = DICOMViewerApp(root)
     root.bind('<Configure>', lambda e: app.update_image() if app.data_loader.is_loaded else None)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    app.data_loader.close()